@@ -1,25 +1,54 @@
 import os
+import re
+import sys
+import gzip
 import json
+import hmac
 import click
+import signal
+import hashlib
+import queue
+import atexit
 import logging
+import threading
 import typing as t
 
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 
 from flask import Flask, request, abort
 from flask_cors import CORS
+from waitress import serve
+
+try:
+    import orjson  # type: ignore[import-not-found, unused-ignore]
+except ImportError:
+    orjson = None  # type: ignore
 
 
 PROG_NAME: str = "nbagent"
 
 CONFIG_FILE: str = "app-config.json"
-REV_FILE_PATTERN: str = "rev-{0:08}.json"
+COMPRESSED_SUFFIX: str = ".gz"
+COMPRESS_LEVEL: int = 3
 META_FILE: str = "meta.json"
 BOARDS_SUBDIR: str = "boards"
 DELETED_BOARDS_SUBDIR: str = "deleted"
 
+BOARD_ID_RE: t.Pattern[str] = re.compile(r"[A-Za-z0-9_-]+")
+
+WRITE_QUEUE_SIZE: int = 1024
+WRITE_BATCH_SIZE: int = 64
+WRITE_FLUSH_SECS: float = 0.005
+PERSIST_WORKERS: int = 4
+MAX_PENDING_SAVES: int = 64
+PREALLOCATE_SIZE: int = 256 * 1024
+UNCACHED_WRITE_SIZE: int = 1024 * 1024
+
 DFAULT_ADDR: str = "0.0.0.0"
 DEFAULT_PORT: int = 10001
+DEFAULT_THREADS: int = 8
 
 DATA_HOME: str = os.environ.get("XDG_DATA_HOME") or os.path.join(
     os.environ.get("HOME", "~"), ".local/share"
@@ -29,26 +58,106 @@ CONFIG: t.Dict[str, t.Any] = {}
 
 # To be assigned during initialization
 BOARDS_HOME: str = ""
+BOARDS_HOME_PREFIX: str = ""
 DELETED_BOARDS_HOME: str = ""
+AUTH_TOKEN: bytes = b""
+COMPRESS_REVS: bool = False
+
+# Pending (path, payload, on_written) writes, drained by the writer thread.
+# on_written gets whether the write succeeded. A job with an empty path is a
+# flush marker, notified once every job queued before it has been written.
+WriteCallback = t.Callable[[bool], None]
+WriteJob = t.Tuple[str, bytes, t.Optional[WriteCallback]]
+_write_queue: "queue.Queue[t.Optional[WriteJob]]" = queue.Queue(WRITE_QUEUE_SIZE)
+_writer: t.Optional[threading.Thread] = None
+
+# Boards are serialized and written off the request thread. Each board always
+# maps to the same single-worker pool, so its saves are handled in order.
+_persist_pools: t.List[ThreadPoolExecutor] = [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"nbagent-persist-{i}")
+    for i in range(PERSIST_WORKERS)
+]
+# The pools' queues are unbounded, so cap the saves waiting in them; request
+# threads block here instead of piling up parsed boards in memory
+_pending_saves: threading.BoundedSemaphore = threading.BoundedSemaphore(
+    MAX_PENDING_SAVES
+)
+
+# Directories of the boards already known to exist on disk
+_board_paths: t.Dict[str, str] = {}
+
+# Digest of the last meta.json queued for each board
+_meta_hashes: t.Dict[str, bytes] = {}
+
+# Revision number and digest of the last revision queued for each board
+_last_revs: t.Dict[str, t.Tuple[int, bytes]] = {}
+
+
+class ConsoleHandler(logging.Handler):
+    STYLES: t.Dict[int, t.Tuple[str, t.Dict[str, t.Any]]] = {
+        logging.DEBUG: ("d", {}),
+        logging.INFO: ("i", {"fg": "white"}),
+        logging.WARNING: ("!", {"fg": "yellow"}),
+        logging.ERROR: ("e", {"fg": "red", "err": True}),
+    }
+
+    def emit(self, record: logging.LogRecord) -> None:
+        level_char, kwargs = self.STYLES.get(record.levelno, ("?", {}))
+        click.secho(f" * [{level_char}] {record.getMessage()}", **kwargs)
+
+
+# Request threads only enqueue records; a listener thread does the terminal I/O
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_listener: t.Optional[QueueListener] = None
 
+logger: logging.Logger = logging.getLogger(PROG_NAME)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(QueueHandler(_log_queue))
+logger.propagate = False
 
-def message_printer(level_char: str, **kwargs: t.Any) -> t.Callable[[str], None]:
+
+def message_printer(level: int) -> t.Callable[[str], None]:
     def f(message: str) -> None:
-        click.secho(f" * [{level_char}] {message}", **kwargs)
+        logger.log(level, message)
 
     return f
 
 
-msg_debug = message_printer("d")
-msg_info = message_printer("i", fg="white")
-msg_important = message_printer("!", fg="yellow")
-msg_err = message_printer("e", fg="red", err=True)
+msg_debug = message_printer(logging.DEBUG)
+msg_info = message_printer(logging.INFO)
+msg_important = message_printer(logging.WARNING)
+msg_err = message_printer(logging.ERROR)
+
+
+def start_logging() -> None:
+    global _log_listener
+
+    if _log_listener is None:
+        _log_listener = QueueListener(_log_queue, ConsoleHandler())
+        _log_listener.start()
+        # Registered before the writer's shutdown, so it runs after it and
+        # still prints any errors from the final writes
+        atexit.register(_log_listener.stop)
+
+
+def json_loads(raw: t.Union[bytes, str]) -> t.Any:
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def json_dumps(data: t.Any, pretty: bool = False) -> bytes:
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else None)
+    if pretty:
+        return json.dumps(data, indent=2).encode("utf-8")
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
 
 
 def load_json(path: str, handle_errors: bool = True) -> t.Dict[str, t.Any]:
     try:
-        with open(path, "r") as f:
-            return json.loads(f.read())
+        with open(path, "rb") as f:
+            return json_loads(f.read())
     except Exception as ex:
         if handle_errors:
             msg_err(f"Error reading from {path}: {ex}")
@@ -56,10 +165,208 @@ def load_json(path: str, handle_errors: bool = True) -> t.Dict[str, t.Any]:
         raise
 
 
-def write_json(path: str, data: t.Dict[str, t.Any]) -> None:
+def replace_file(path: str, payload: bytes) -> None:
+    # Write to a temp file and swap it in, so readers never see a torn file.
+    # The name is unique per thread, as writes may also happen off the writer.
+    tmp_path: str = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        fd: int = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if len(payload) >= PREALLOCATE_SIZE and hasattr(os, "posix_fallocate"):
+                # Allocate big files up front instead of extent by extent. Where
+                # the filesystem lacks fallocate, glibc emulates it by writing
+                # zeros, which is why small files (the common case) skip this.
+                try:
+                    os.posix_fallocate(fd, 0, len(payload))
+                except OSError:
+                    pass  # e.g. EOPNOTSUPP from some libcs; the write still works
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_file(path: str, payload: bytes) -> bool:
+    try:
+        try:
+            replace_file(path, payload)
+        except FileNotFoundError:
+            # The directory went away behind our back (manual cleanup, a
+            # restore...), so forget it was known and recreate it once
+            dir_path: str = os.path.dirname(path)
+            if BOARDS_HOME_PREFIX and dir_path.startswith(BOARDS_HOME_PREFIX):
+                _board_paths.pop(dir_path[len(BOARDS_HOME_PREFIX) :], None)
+            ensure_path(dir_path)
+            replace_file(path, payload)
+        return True
+    except Exception as ex:
+        msg_err(f"Error writing to {path}: {ex}")
+        return False
+
+
+def drop_cached(path: str) -> None:
+    # Big revisions are rarely read back: flush them and drop their pages so
+    # they don't evict hotter data from the cache
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd: int = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as ex:
+        msg_debug(f"Couldn't drop {path} from the page cache: {ex}")
+
+
+def notify_written(callbacks: t.List[WriteCallback], ok: bool) -> None:
+    for callback in callbacks:
+        try:
+            callback(ok)
+        except Exception as ex:
+            msg_err(f"Error in write callback: {ex}")
+
+
+def writer_loop() -> None:
+    while True:
+        # Block for the first job, then grab whatever else arrives
+        # within the flush window and write the whole batch
+        batch: t.List[t.Optional[WriteJob]] = [_write_queue.get()]
+        while batch[-1] is not None and len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get(timeout=WRITE_FLUSH_SECS))
+            except queue.Empty:
+                break
+
+        # Later writes to a path supersede earlier ones in the same batch,
+        # so only the latest payload for each path reaches the disk
+        pending: t.Dict[str, t.Tuple[bytes, t.List[WriteCallback]]] = {}
+        markers: t.List[WriteCallback] = []
+        for job in batch:
+            if job is not None:
+                path, payload, on_written = job
+                if not path:
+                    if on_written:
+                        markers.append(on_written)
+                    continue
+                callbacks = pending.pop(path, (b"", []))[1]
+                if on_written:
+                    callbacks.append(on_written)
+                pending[path] = (payload, callbacks)
+
+        uncached: t.List[str] = []
+        for path, (payload, callbacks) in pending.items():
+            ok: bool = write_file(path, payload)
+            if ok and len(payload) >= UNCACHED_WRITE_SIZE:
+                uncached.append(path)
+            notify_written(callbacks, ok)
+
+        # Coalescing may reorder writes within the batch, so release flush
+        # markers only once the whole batch is on disk
+        notify_written(markers, True)
+
+        # Flushing big files to the device is slow, so it's done once the
+        # batch has been written and notified. It still delays the next
+        # batch, a trade-off accepted to keep the page cache clean.
+        for path in uncached:
+            drop_cached(path)
+
+        if batch[-1] is None:
+            return
+
+
+def start_writer() -> None:
+    global _writer
+
+    if _writer is None:
+        _writer = threading.Thread(
+            target=writer_loop, name="nbagent-writer", daemon=True
+        )
+        _writer.start()
+        atexit.register(shutdown)
+
+
+def stop_writer() -> None:
+    global _writer
+
+    if _writer is not None:
+        _write_queue.put(None)
+        _writer.join()
+        _writer = None
+
+
+def shutdown() -> None:
+    # Let queued saves reach the writer before stopping it
+    for pool in _persist_pools:
+        pool.shutdown(wait=True)
+    stop_writer()
+
+
+def flush_writes() -> None:
+    # Waits for the writes queued so far, not for the queue to become empty
+    if _writer is not None:
+        done: threading.Event = threading.Event()
+        _write_queue.put(("", b"", lambda ok: done.set()))
+        done.wait()
+
+
+def enqueue_write(
+    path: str,
+    payload: bytes,
+    sync: bool = False,
+    on_written: t.Optional[WriteCallback] = None,
+) -> None:
+    if _writer is None:
+        ok: bool = write_file(path, payload)
+        if on_written:
+            notify_written([on_written], ok)
+        return
+
+    # The serialized bytes are handed over as-is and written from a memoryview,
+    # so there's no copy between serializer and disk. Since the writer owns
+    # them until flushed, they can't come from a reusable per-thread buffer.
+    if not sync:
+        _write_queue.put((path, payload, on_written))
+        return
+
+    done: threading.Event = threading.Event()
+
+    def notify(ok: bool) -> None:
+        if on_written:
+            on_written(ok)
+        done.set()
+
+    _write_queue.put((path, payload, notify))
+    done.wait()
+
+
+def remember_queued(cache: t.Dict[str, t.Any], key: str, value: t.Any) -> WriteCallback:
+    # Record the write as soon as it's queued, so a later request matching it
+    # is compared against what will end up on disk. If the write fails, forget
+    # it (unless a newer write took its place) so a retry is written in full.
+    cache[key] = value
+
+    def f(ok: bool) -> None:
+        if not ok and cache.get(key) == value:
+            cache.pop(key, None)
+
+    return f
+
+
+def write_json(
+    path: str, data: t.Dict[str, t.Any], pretty: bool = False, sync: bool = False
+) -> None:
     try:
-        with open(path, "w") as f:
-            f.write(json.dumps(data, indent=2))
+        enqueue_write(path, json_dumps(data, pretty=pretty), sync=sync)
     except Exception as ex:
         msg_err(f"Error writing to {path}: {ex}")
 
@@ -76,15 +383,37 @@ def load_config() -> t.Dict[str, t.Any]:
 
 def write_config() -> None:
     conf_path: str = os.path.join(DATA_HOME, CONFIG_FILE)
-    write_json(conf_path, CONFIG)
+    # The config is the only file meant to be read by humans
+    write_json(conf_path, CONFIG, pretty=True, sync=True)
     msg_info(f"Config saved to {conf_path}")
 
 
+def rev_file_name(rev: int) -> str:
+    if COMPRESS_REVS:
+        return f"rev-{rev:08d}.json{COMPRESSED_SUFFIX}"
+    return f"rev-{rev:08d}.json"
+
+
 def ensure_path(path: str) -> str:
     os.makedirs(path, exist_ok=True)
     return path
 
 
+def check_board_id(board_id: str) -> None:
+    # Board paths are built by plain concatenation, so keep ids to safe names
+    if not BOARD_ID_RE.fullmatch(board_id):
+        raise ValueError(f"Invalid board id '{board_id}'")
+
+
+def ensure_board_path(board_id: str) -> str:
+    path: t.Optional[str] = _board_paths.get(board_id)
+    if path is None:
+        check_board_id(board_id)
+        path = ensure_path(BOARDS_HOME_PREFIX + board_id)
+        _board_paths[board_id] = path
+    return path
+
+
 app = Flask(__name__)
 CORS(app)
 
@@ -95,27 +424,92 @@ def check_token() -> None:
         return
 
     token: t.Optional[str] = request.headers.get("X-Access-Token")
-    if not token or token != CONFIG.get("auth"):
+    if not token or not hmac.compare_digest(token.encode(), AUTH_TOKEN):
         msg_important(f"Unauthorized request from {request.remote_addr} rejected")
         abort(401)
 
 
+def read_board_payload() -> t.Tuple[t.Dict[str, t.Any], t.Dict[str, t.Any]]:
+    if request.is_json:
+        # A JSON body ({"data": {...}, "meta": {...}}) is parsed in a single
+        # pass, without Werkzeug's form decoding
+        body: t.Dict[str, t.Any] = json_loads(request.get_data(cache=False))
+        return body.get("data") or {}, body.get("meta") or {}
+
+    # Nullboard itself sends both fields as JSON strings in a urlencoded form
+    return (
+        json_loads(request.form.get("data", "{}")),
+        json_loads(request.form.get("meta", "{}")),
+    )
+
+
+def persist_pool(board_id: str) -> ThreadPoolExecutor:
+    return _persist_pools[hash(board_id) % len(_persist_pools)]
+
+
+def persist_board(
+    board_id: str,
+    board_path: str,
+    title: str,
+    rev: int,
+    data: t.Dict[str, t.Any],
+    meta: t.Dict[str, t.Any],
+) -> None:
+    try:
+        # Clients retry the same revision on flaky networks; write it only once
+        data_bytes: bytes = json_dumps(data)
+        last_rev = (rev, hashlib.blake2b(data_bytes, digest_size=16).digest())
+        if _last_revs.get(board_id) != last_rev:
+            if COMPRESS_REVS:
+                data_bytes = gzip.compress(data_bytes, COMPRESS_LEVEL, mtime=0)
+            remember_rev = remember_queued(_last_revs, board_id, last_rev)
+
+            def on_rev_written(ok: bool) -> None:
+                remember_rev(ok)
+                if ok:
+                    msg_info(f"Saved board '{title}' ({board_id}), rev {rev}...")
+
+            enqueue_write(
+                board_path + os.sep + rev_file_name(rev),
+                data_bytes,
+                on_written=on_rev_written,
+            )
+        else:
+            msg_info(f"Board '{title}' ({board_id}), rev {rev} already saved")
+
+        # Meta rarely changes between saves, so skip rewriting identical content
+        meta_bytes: bytes = json_dumps(meta)
+        meta_hash: bytes = hashlib.blake2b(meta_bytes, digest_size=16).digest()
+        if _meta_hashes.get(board_id) != meta_hash:
+            enqueue_write(
+                board_path + os.sep + META_FILE,
+                meta_bytes,
+                on_written=remember_queued(_meta_hashes, board_id, meta_hash),
+            )
+    except Exception as ex:
+        msg_err(f"Error saving board {board_id}: {ex}")
+
+
 @app.route("/board/<board_id>", methods=["PUT"])
 def save_board(board_id: str) -> str:
     try:
-        board_path: str = ensure_path(os.path.join(BOARDS_HOME, board_id))
-
-        data = json.loads(request.form.get("data", "{}"))
-        meta = json.loads(request.form.get("meta", "{}"))
+        board_path: str = ensure_board_path(board_id)
 
+        # Parse and validate here, so bad requests are still answered "false".
+        # Only serializing and writing happen off the request thread.
+        data, meta = read_board_payload()
         rev: int = int(data.get("revision", "0"))
-        data_path = os.path.join(board_path, REV_FILE_PATTERN.format(rev))
-        write_json(data_path, data)
-
-        meta_path = os.path.join(board_path, META_FILE)
-        write_json(meta_path, meta)
-
-        msg_info(f"Saved board '{data['title']}' ({board_id}), rev {rev}...")
+        title: str = data["title"]
+
+        _pending_saves.acquire()
+        try:
+            future = persist_pool(board_id).submit(
+                persist_board, board_id, board_path, title, rev, data, meta
+            )
+        except Exception:
+            _pending_saves.release()
+            raise
+        future.add_done_callback(lambda _: _pending_saves.release())
         return "true"
     except Exception as ex:
         msg_err(f"Error saving board {board_id}: {ex}")
@@ -124,10 +518,23 @@ def save_board(board_id: str) -> str:
 
 @app.route("/board/<board_id>", methods=["DELETE"])
 def nuke_board(board_id: str) -> str:
+    try:
+        check_board_id(board_id)
+    except ValueError as ex:
+        msg_err(f"Error deleting board: {ex}")
+        return "false"
+
     old_path: str = os.path.join(BOARDS_HOME, board_id)
     new_path: str = os.path.join(DELETED_BOARDS_HOME, board_id)
 
     try:
+        # Don't let pending saves land on (or fail against) a moved board.
+        # Saves queued for other boards afterwards are not waited for.
+        persist_pool(board_id).submit(lambda: None).result()
+        flush_writes()
+        _board_paths.pop(board_id, None)
+        _meta_hashes.pop(board_id, None)
+        _last_revs.pop(board_id, None)
         os.rename(old_path, new_path)
         return "true"
     except Exception as ex:
@@ -145,17 +552,28 @@ def save_config() -> str:
 
 
 def init(
-    data: t.Optional[str], reset_token: bool, override_token: t.Optional[str]
+    data: t.Optional[str],
+    reset_token: bool,
+    override_token: t.Optional[str],
+    compress: bool = False,
 ) -> None:
     global DATA_HOME
     global CONFIG
     global BOARDS_HOME
+    global BOARDS_HOME_PREFIX
     global DELETED_BOARDS_HOME
+    global AUTH_TOKEN
+    global COMPRESS_REVS
+
+    start_logging()
+    start_writer()
 
     DATA_HOME = ensure_path(data or DATA_HOME)
     msg_info(f"Using data directory {DATA_HOME}")
 
     BOARDS_HOME = ensure_path(os.path.join(DATA_HOME, BOARDS_SUBDIR))
+    BOARDS_HOME_PREFIX = BOARDS_HOME + os.sep
+    COMPRESS_REVS = compress
     DELETED_BOARDS_HOME = ensure_path(os.path.join(DATA_HOME, DELETED_BOARDS_SUBDIR))
     CONFIG = load_config()
 
@@ -168,12 +586,14 @@ def init(
 
     # Use an autogenerated one if needed and save it
     if reset_token or ("auth" not in CONFIG):
-        CONFIG["auth"] = str(uuid4()).replace("-", "")  # What can I say? I'm lazy...
+        CONFIG["auth"] = uuid4().hex  # What can I say? I'm lazy...
         save = True
 
     if save:
         write_config()
 
+    AUTH_TOKEN = CONFIG["auth"].encode()
+
 
 def start_server(
     addr: str,
@@ -181,14 +601,25 @@ def start_server(
     data: t.Optional[str],
     reset_token: bool,
     override_token: t.Optional[str],
+    threads: int = DEFAULT_THREADS,
+    debug: bool = False,
+    compress: bool = False,
 ) -> None:
-    init(data, reset_token, override_token)
+    init(data, reset_token, override_token, compress)
+
+    # Saves are acknowledged before they reach the disk, so turn SIGTERM
+    # (systemctl/docker stop, kill) into a normal exit that drains them
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
 
     msg_important(f"Nullboard token: {CONFIG['auth']}")
 
     msg_info(f"Server listening {addr}:{port}...")
     try:
-        app.run(host=addr, port=port, debug=False)
+        if debug:
+            # Never enable Werkzeug's debugger: its console skips the token check
+            app.run(host=addr, port=port, debug=False)
+        else:
+            serve(app, host=addr, port=port, threads=threads)
     except Exception as ex:
         msg_err(f"Error starting server: {ex}")
 
@@ -227,12 +658,35 @@ def start_server(
 @click.option(
     "--override-token", required=False, type=str, help="Use a custom auth token"
 )
+@click.option(
+    "--threads",
+    required=False,
+    type=int,
+    default=DEFAULT_THREADS,
+    show_default=True,
+    help="Number of request handling threads",
+)
+@click.option(
+    "--compress",
+    required=False,
+    is_flag=True,
+    help="Store board revisions gzip-compressed",
+)
+@click.option(
+    "--debug",
+    required=False,
+    is_flag=True,
+    help="Use Flask's development server instead of waitress",
+)
 def cli(
     addr: str,
     port: int,
     data: t.Optional[str],
     reset_token: bool,
     override_token: t.Optional[str],
+    threads: int,
+    compress: bool,
+    debug: bool,
 ) -> None:
     """A Nullboard backup agent"""
     try:
@@ -247,6 +701,9 @@ def cli(
         data=data,
         reset_token=reset_token,
         override_token=override_token,
+        threads=threads,
+        debug=debug,
+        compress=compress,
     )
 
 